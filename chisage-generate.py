@@ -8,22 +8,29 @@ __license_url__ = "https://www.apache.org/licenses/LICENSE-2.0"
 __thanks__ = "Thanks to Chisage Company for their support and high quality modbus documentation."
 
 from dataclasses import dataclass
+from functools import cached_property
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional
 import yaml
 import os
 import argparse
-import re # Import re for string replacement
-
-# Custom class and representer for PyYAML to handle !include tags without quotes
-# class IncludeTag(str):
-#     pass
-# 
-# def represent_include_tag(dumper, data):
-#     return dumper.represent_scalar('tag:yaml.org,2002:str', str(data), style='') # Plain style, no quotes
-# 
-# yaml.add_representer(IncludeTag, represent_include_tag)
-
-# --- PyYAML Customization for Loading !include --- 
+import ipaddress
+import json
+import marshal
+import math
+import re
+import shutil
+import tempfile
+
+# --- PyYAML Customization for !include ---
+# Marks a string as an "!include <path>" directive so it is emitted as an unquoted tag instead of a quoted string
+class IncludeTag(str):
+    pass
+
+def represent_include_tag(dumper, data):
+    # Plain style, no quotes (the pure-Python fallback needs IncludeSafeDumper below for this)
+    return dumper.represent_scalar('!include', data[len('!include '):], style='')
+
 def include_constructor(loader, node):
     # Treat the !include tag as a plain string by returning the tag itself with its value
     # For example, if YAML is "!include foo.yaml", node.tag will be "!include"
@@ -31,15 +38,99 @@ def include_constructor(loader, node):
     # However, for unquoted tags like !include, node.value is the whole string after tag.
     # For parsing `sensors: !include path/file.yaml`
     # node will be a ScalarNode, node.tag will be u'!include', node.value is path/file.yaml
-    # We want to return the literal string "!include path/file.yaml"
-    return node.tag + ' ' + node.value
-
-# Add the constructor to the SafeLoader
+    # We want to return the literal string "!include path/file.yaml", wrapped so it dumps back unquoted
+    return IncludeTag(node.tag + ' ' + node.value)
+
+class IncludeSafeDumper(yaml.SafeDumper):
+    # The pure-Python emitter never picks plain style for an explicitly tagged scalar and would write
+    # `!include 'chisage/x.yaml'`; allow it for !include so the output matches libyaml's
+    def choose_scalar_style(self):
+        if self.event.tag == '!include' and self.event.style == '':
+            if self.analysis is None:
+                self.analysis = self.analyze_scalar(self.event.value)
+            if (not self.analysis.empty and not self.analysis.multiline
+                    and (self.analysis.allow_flow_plain if self.flow_level else self.analysis.allow_block_plain)):
+                return ''
+        return super().choose_scalar_style()
+
+# Prefer the libyaml-backed C loader/dumper when PyYAML was built with it, fall back to pure Python otherwise
+YamlLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+YamlDumper = getattr(yaml, "CSafeDumper", IncludeSafeDumper)
+
+# Add the constructor to the SafeLoader (constructors registered on SafeLoader don't carry over to CSafeLoader)
 yaml.add_constructor('!include', include_constructor, Loader=yaml.SafeLoader)
-# Also add to Dumper if we were to load and dump with complex tags, but for output we use string replacement
-
-
-@dataclass
+yaml.add_constructor('!include', include_constructor, Loader=YamlLoader)
+# Same for the representer on the dumpers
+yaml.add_representer(IncludeTag, represent_include_tag, Dumper=yaml.SafeDumper)
+yaml.add_representer(IncludeTag, represent_include_tag, Dumper=IncludeSafeDumper)
+yaml.add_representer(IncludeTag, represent_include_tag, Dumper=YamlDumper)
+
+
+# --- Fixed-schema writer for sensor files ---
+# Sensor files are a flat list of dicts with string/number values, so they can be written directly
+# without going through PyYAML's generic representer/emitter. Strings that are not obviously safe as
+# plain scalars are written as JSON strings, which are valid YAML double-quoted scalars.
+_PLAIN_SCALAR_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_ ./-]*")
+_YAML_RESERVED_WORDS = frozenset(("y", "n", "yes", "no", "true", "false", "on", "off", "null"))
+# Characters that JSON leaves raw with ensure_ascii=False but YAML either forbids unescaped or reads as line breaks
+_YAML_UNSAFE_CHARS_RE = re.compile("[\x7f-\x9f\u2028\u2029\ud800-\udfff\ufeff\ufffe\uffff]")
+
+def _escape_yaml_unsafe(json_text: str) -> str:
+    return _YAML_UNSAFE_CHARS_RE.sub(lambda m: f"\\u{ord(m.group()):04x}", json_text)
+
+def _format_scalar(value) -> str:
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return str(value)
+    if isinstance(value, float):
+        if math.isnan(value):
+            return ".nan"
+        if math.isinf(value):
+            return ".inf" if value > 0 else "-.inf"
+        text = repr(value)
+        if "e" in text and "." not in text:
+            # YAML 1.1 only resolves exponent floats with a dot in the mantissa (1.0e-05, not 1e-05)
+            text = text.replace("e", ".0e", 1)
+        return text
+    text = str(value)
+    if (_PLAIN_SCALAR_RE.fullmatch(text) and not text.endswith(" ")
+            and text.lower() not in _YAML_RESERVED_WORDS):
+        return text
+    # ensure_ascii=False keeps non-BMP characters intact; with escaping they would become \udXXX surrogate pairs,
+    # which YAML decodes as two lone surrogates instead of the original character
+    quoted = json.dumps(text, ensure_ascii=False)
+    return _escape_yaml_unsafe(quoted)
+
+def _dump_sensor_list(sensor_dicts: list[dict]) -> str:
+    lines = []
+    for sensor in sensor_dicts:
+        prefix = "- "
+        for key, value in sensor.items():
+            lines.append(f"{prefix}{key}: {_format_scalar(value)}\n")
+            prefix = "  "
+    return "".join(lines)
+
+
+# Large enough to hold a whole generated file, so each one goes out in a single write() call
+WRITE_BUFFER_SIZE = 64 * 1024
+
+def _write_file_bytes(path: str, data: bytes) -> None:
+    # Output is serialized up front and written through a binary handle: no text-mode encoding or
+    # newline translation layer, and one write() for the whole file
+    with open(path, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+        f.write(data)
+
+# Turns a device/sensor name into its file name / entity ID form ("Chisage 1" -> "chisage_1") in one C-level pass
+_SANITIZE_TRANS = str.maketrans({' ': '_', '-': '_'})
+
+def _sanitize(s: str) -> str:
+    return s.translate(_SANITIZE_TRANS).lower()
+
+
+@dataclass(slots=True)
 class ModbusRegister:
     name: str
     slave: int
@@ -49,22 +140,19 @@ class ModbusRegister:
     unit_of_measurement: Optional[str] = None
     scan_interval: Optional[int] = None
     state_class: Optional[str] = None
+    # Name without the device prefix (e.g. "Inverter Voltage A"), used for card labels; not part of the sensor config
+    short_name: Optional[str] = None
+
+    # Field order of the emitted sensor config; optional fields are left out when unset
+    _REQUIRED = ("name", "slave", "address", "data_type")
+    _OPTIONAL = ("scale", "unit_of_measurement", "scan_interval", "state_class")
 
     def to_dict(self) -> dict:
-        result = {
-            "name": self.name,
-            "slave": self.slave,
-            "address": self.address,
-            "data_type": self.data_type,
-        }
-        if self.scale is not None:
-            result["scale"] = self.scale
-        if self.unit_of_measurement is not None:
-            result["unit_of_measurement"] = self.unit_of_measurement
-        if self.scan_interval is not None:
-            result["scan_interval"] = self.scan_interval
-        if self.state_class is not None:
-            result["state_class"] = self.state_class
+        result = {k: getattr(self, k) for k in self._REQUIRED}
+        for k in self._OPTIONAL:
+            v = getattr(self, k)
+            if v is not None:
+                result[k] = v
         return result
 
 class ModbusDevice:
@@ -86,29 +174,181 @@ class ModbusDevice:
                 if sensor.scan_interval is None:
                     sensor.scan_interval = default_sensor_scan_interval
 
+    @cached_property
+    def sensor_dicts(self) -> list[dict]:
+        # Built once per device and shared by to_dict() and write_sensors_file(); the sensor list is
+        # not expected to change after construction
+        return [sensor.to_dict() for sensor in self.sensors]
+
     def to_dict(self) -> dict:
         return {
             "name": self.name,
             "slave": self.slave,
-            "sensors": [sensor.to_dict() for sensor in self.sensors],
+            "sensors": self.sensor_dicts,
         }
 
-    def make_config(self, device_port_for_hub: int) -> None:
-        sensor_config_list = [s.to_dict() for s in self.sensors]
+    @property
+    def sensors_file_path(self) -> str:
+        safe_device_name_part = _sanitize(self.name)
+        return f"chisage/{safe_device_name_part}_sensors.yaml"
 
-        os.makedirs("chisage", exist_ok=True)
-        safe_device_name_part = self.name.lower().replace(' ', '_').replace('-', '_')
-        sensors_file_path = f"chisage/{safe_device_name_part}_sensors.yaml"
+    def write_sensors_file(self, safe_yaml: bool = False) -> str:
+        # The chisage/ directory is created once by the caller, not per device
+        sensor_config_list = self.sensor_dicts
+        sensors_file_path = self.sensors_file_path
         
-        with open(sensors_file_path, "w") as f:
-            yaml.dump(sensor_config_list, f, sort_keys=False, indent=2)
+        if safe_yaml:
+            data = yaml.dump(sensor_config_list, sort_keys=False, indent=2, Dumper=YamlDumper, encoding="utf-8")
+        else:
+            data = _dump_sensor_list(sensor_config_list).encode("utf-8")
+        _write_file_bytes(sensors_file_path, data)
+        return sensors_file_path
+
+    def build_hub_entry(self, device_port_for_hub: int) -> dict:
+        return {
+            "name": self.name,
+            "type": "tcp",
+            "host": self.host, 
+            "port": device_port_for_hub, 
+            "sensors": IncludeTag(f"!include {self.sensors_file_path}")
+        }
+
+    @property
+    def card_file_path(self) -> str:
+        return f"chisage/{_sanitize(self.name)}_card.yaml"
+
+    def build_card_config(self) -> dict:
+        card_entities = []
+        for reg in self.sensors:
+            # reg.name is already like "Chisage 1 Inverter Voltage A"
+            # Home Assistant's Modbus integration typically creates entity IDs like:
+            # sensor.hub_name_sensor_name (all lowercase, spaces to underscores)
+            # The hub name is self.name (e.g., "Chisage 1")
+            # The sensor name on the hub is reg.name itself.
+            
+            # Sanitize sensor name for entity ID part
+            sensor_name_sanitized = _sanitize(reg.name)
+            
+            # If sensor name already contains hub name, avoid duplication for suffix
+            # This logic assumes sensor names like "Chisage 1 Power" and hub name "Chisage 1"
+            # We want entity id sensor.chisage_1_power
+            # The Modbus integration does this: sensor.[hub_name]_[sensor_name_from_config_on_hub]
+            # Our current reg.name is the full desired name, also used in sensor config
+
+            entity_id = f"sensor.{sensor_name_sanitized}" # reg.name already has device name
+
+            # For display name in card, use the name without device prefix where the register has one
+            display_name_in_card = reg.short_name if reg.short_name is not None else reg.name
+            
+            card_entities.append({
+                "entity": entity_id,
+                "name": display_name_in_card
+            })
 
-        modbus_hubs_filename = "modbus_devices.yaml"
-        modbus_hubs_list = [] 
+        return {
+            "type": "entities",
+            "title": self.name, # e.g., "Chisage 1"
+            "entities": card_entities
+        }
+
+    def write_card_file(self, safe_yaml: bool = False) -> str:
+        card_config = self.build_card_config()
+        card_filename = self.card_file_path
+        
+        if safe_yaml:
+            data = yaml.dump(card_config, sort_keys=False, indent=2, Dumper=YamlDumper, encoding="utf-8")
+        else:
+            # JSON is valid YAML, so Home Assistant reads the card file the same way
+            # Same escaping rules as quoted strings in sensor files (see _format_scalar)
+            data = _escape_yaml_unsafe(json.dumps(card_config, indent=2, ensure_ascii=False)).encode("utf-8")
+        _write_file_bytes(card_filename, data)
+        return card_filename
+
+    def make_config(self, device_port_for_hub: int, safe_yaml: bool = False) -> dict:
+        # Writes the sensor file and returns the hub entry. Only touches this device's own file, so it is safe
+        # to run on a worker thread; the caller merges the entry into the shared hub list (see load_modbus_hubs /
+        # write_modbus_hubs) so modbus_devices.yaml is parsed and written once per run
+        self.write_sensors_file(safe_yaml=safe_yaml)
+        return self.build_hub_entry(device_port_for_hub)
+
+
+MODBUS_HUBS_FILENAME = "modbus_devices.yaml"
+
+# Sidecar cache of the parsed hub list, keyed on the YAML file's mtime and size so repeated runs
+# can skip YAML parsing when modbus_devices.yaml hasn't been touched since we last wrote it.
+# Stored with marshal, which only (de)serializes plain data and never runs code from the file.
+# Bump the version whenever the cached structure changes.
+_HUBS_CACHE_VERSION = 2
+
+def _hubs_cache_path(modbus_hubs_filename: str) -> str:
+    directory, basename = os.path.split(modbus_hubs_filename)
+    return os.path.join(directory, f".{os.path.splitext(basename)[0]}.cache.bin")
+
+def _to_cache_data(value):
+    # marshal only takes exact built-in types: IncludeTag becomes a ("!include", path) tuple, which
+    # can't be confused with loaded YAML data since the safe loader never produces tuples
+    if isinstance(value, IncludeTag):
+        return ("!include", str(value))
+    if isinstance(value, dict):
+        return {_to_cache_data(k): _to_cache_data(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_to_cache_data(v) for v in value]
+    return value
+
+def _from_cache_data(value):
+    if isinstance(value, tuple):
+        return IncludeTag(value[1])
+    if isinstance(value, dict):
+        return {_from_cache_data(k): _from_cache_data(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_from_cache_data(v) for v in value]
+    return value
+
+def _read_hubs_cache(modbus_hubs_filename: str, stat_result: os.stat_result) -> Optional[list]:
+    try:
+        with open(_hubs_cache_path(modbus_hubs_filename), "rb") as f:
+            version, mtime_ns, size, cached_list = marshal.load(f)
+        if version != _HUBS_CACHE_VERSION or mtime_ns != stat_result.st_mtime_ns or size != stat_result.st_size:
+            return None
+        if not isinstance(cached_list, list):
+            return None
+        return _from_cache_data(cached_list)
+    except Exception:
+        # Missing, stale-format or corrupt cache: it's only an optimization, fall back to parsing the YAML
+        return None
+
+def _write_hubs_cache(modbus_hubs_filename: str, modbus_hubs_list: list) -> None:
+    try:
+        stat_result = os.stat(modbus_hubs_filename)
+        data = marshal.dumps((_HUBS_CACHE_VERSION, stat_result.st_mtime_ns, stat_result.st_size, _to_cache_data(modbus_hubs_list)))
+    except ValueError:
+        # Hub list holds values marshal can't store (e.g. YAML timestamps); just go without a cache
+        return
+    except OSError as e:
+        print(f"Warning: Could not write cache for {modbus_hubs_filename}: {e}")
+        return
+    try:
+        with open(_hubs_cache_path(modbus_hubs_filename), "wb") as f:
+            f.write(data)
+    except OSError as e:
+        # The cache is only an optimization, never fail the run because of it
+        print(f"Warning: Could not write cache for {modbus_hubs_filename}: {e}")
+
+def load_modbus_hubs(modbus_hubs_filename: str = MODBUS_HUBS_FILENAME) -> dict:
+    modbus_hubs_list = [] 
+    try:
+        stat_result = os.stat(modbus_hubs_filename)
+    except FileNotFoundError:
+        stat_result = None
+
+    cached_list = _read_hubs_cache(modbus_hubs_filename, stat_result) if stat_result is not None else None
+    if cached_list is not None:
+        modbus_hubs_list = cached_list
+    elif stat_result is not None:
         try:
             with open(modbus_hubs_filename, "r") as f:
-                # Now safe_load will use our include_constructor for !include tags
-                loaded_data = yaml.safe_load(f) 
+                # Now the loader will use our include_constructor for !include tags
+                loaded_data = yaml.load(f, Loader=YamlLoader)
                 if isinstance(loaded_data, list):
                     modbus_hubs_list = loaded_data
                 elif isinstance(loaded_data, dict) and "modbus" in loaded_data and isinstance(loaded_data["modbus"], list):
@@ -121,84 +361,138 @@ class ModbusDevice:
             # This will catch the constructor error if include_constructor is not set up right, or other YAML errors
             print(f"Warning: Error parsing {modbus_hubs_filename}: {e}. The file will be treated as empty or overwritten.")
 
-        hub_entry = {
-            "name": self.name,
-            "type": "tcp",
-            "host": self.host, 
-            "port": device_port_for_hub, 
-            "sensors": f"!include {sensors_file_path}"
-        }
-
-        found = False
-        for i, entry in enumerate(modbus_hubs_list):
-            if isinstance(entry, dict) and entry.get("name") == self.name:
-                modbus_hubs_list[i] = hub_entry
-                found = True
-                break
-        if not found:
-            modbus_hubs_list.append(hub_entry)
-
-        with open(modbus_hubs_filename, "w") as f:
-            yaml_output_string = yaml.dump(modbus_hubs_list, sort_keys=False, indent=2, Dumper=yaml.Dumper)
-            corrected_yaml_string = re.sub(r"'(!include [^']+\.yaml)'", r"\1", yaml_output_string)
-            f.write(corrected_yaml_string)
+    # Keyed by hub name so updates are a dict lookup; insertion order keeps the existing file order.
+    # Entries without a unique string name are kept under a (None, index) key, which can't collide
+    # with a hub name, so they survive the rewrite.
+    hubs_by_name = {}
+    for i, entry in enumerate(modbus_hubs_list):
+        key = entry.get("name") if isinstance(entry, dict) else None
+        if not isinstance(key, str) or key in hubs_by_name:
+            key = (None, i)
+        hubs_by_name[key] = entry
+    return hubs_by_name
+
+def write_modbus_hubs(hubs_by_name: dict, modbus_hubs_filename: str = MODBUS_HUBS_FILENAME) -> None:
+    modbus_hubs_list = list(hubs_by_name.values())
+    data = yaml.dump(modbus_hubs_list, sort_keys=False, indent=2, Dumper=YamlDumper, encoding="utf-8")
+    # Write to a temp file and swap it in, so a crash never leaves a truncated modbus_devices.yaml behind
+    # (which Home Assistant and the next run would fail to parse).
+    # Resolve symlinks first so a linked modbus_devices.yaml is updated in place rather than replaced by a file.
+    target_filename = os.path.realpath(modbus_hubs_filename)
+    target_dir, target_basename = os.path.split(target_filename)
+    try:
+        target_stat = os.stat(target_filename)
+    except FileNotFoundError:
+        target_stat = None
+
+    # Unique temp name, so concurrent runs don't clobber each other's temp file
+    with tempfile.NamedTemporaryFile(dir=target_dir, prefix=f".{target_basename}.", suffix=".tmp", delete=False) as f:
+        tmp_filename = f.name
+    try:
+        with open(tmp_filename, "wb", buffering=WRITE_BUFFER_SIZE) as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if target_stat is not None:
+            # Keep the existing file's mode (and owner, where we are allowed to) instead of the temp file's 0600
+            shutil.copymode(target_filename, tmp_filename)
+            tmp_stat = os.stat(tmp_filename)
+            if (target_stat.st_uid, target_stat.st_gid) != (tmp_stat.st_uid, tmp_stat.st_gid):
+                try:
+                    os.chown(tmp_filename, target_stat.st_uid, target_stat.st_gid)
+                except (PermissionError, AttributeError):
+                    pass
+        else:
+            # New file: same permissions a plain open(..., "w") would have given it
+            current_umask = os.umask(0)
+            os.umask(current_umask)
+            os.chmod(tmp_filename, 0o666 & ~current_umask)
+        os.replace(tmp_filename, target_filename)
+    except BaseException:
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+        raise
+    _write_hubs_cache(modbus_hubs_filename, modbus_hubs_list)
+
+# Chisage register map: (name suffix, address, data_type, scale, unit_of_measurement, state_class).
+# Shared by every ChisageInverter; only the device name prefix and slave ID differ per instance.
+_INVERTER_SENSOR_SPECS: tuple[tuple[str, int, str, Optional[float], str, Optional[str]], ...] = (
+    ("Inverter Voltage A", 26, "uint16", 0.1, "V", None),
+    ("Inverter Voltage B", 27, "uint16", 0.1, "V", None),
+    ("Inverter Voltage C", 28, "uint16", 0.1, "V", None),
+    ("Inverter Current A", 29, "uint16", 0.01, "A", None),
+    ("Inverter Current B", 30, "uint16", 0.01, "A", None),
+    ("Inverter Current C", 31, "uint16", 0.01, "A", None),
+    ("Grid Voltage A", 32, "uint16", 0.1, "V", None),
+    ("Grid Voltage B", 33, "uint16", 0.1, "V", None),
+    ("Grid Voltage C", 34, "uint16", 0.1, "V", None),
+    ("Grid Current A", 35, "uint16", 0.01, "A", None),
+    ("Grid Current B", 36, "uint16", 0.01, "A", None),
+    ("Grid Current C", 37, "uint16", 0.01, "A", None),
+    ("Load Voltage A", 38, "uint16", 0.1, "V", None),
+    ("Load Voltage B", 39, "uint16", 0.1, "V", None),
+    ("Load Voltage C", 40, "uint16", 0.1, "V", None),
+    ("Load Current A", 41, "uint16", 0.01, "A", None),
+    ("Load Current B", 42, "uint16", 0.01, "A", None),
+    ("Load Current C", 43, "uint16", 0.01, "A", None),
+    ("Diesel Generator Voltage A", 44, "uint16", 0.1, "V", None),
+    ("Diesel Generator Voltage B", 45, "uint16", 0.1, "V", None),
+    ("Diesel Generator Voltage C", 46, "uint16", 0.1, "V", None),
+    ("Diesel Generator Current A", 47, "uint16", 0.01, "A", None),
+    ("Diesel Generator Current B", 48, "uint16", 0.01, "A", None),
+    ("Diesel Generator Current C", 49, "uint16", 0.01, "A", None),
+    ("Inverter Positive Bus Voltage", 50, "uint16", 0.1, "V", None),
+    ("Negative Bus Voltage", 51, "uint16", 0.1, "V", None),
+    ("Inverter Frequency", 52, "int16", 0.01, "Hz", None),
+    ("Grid Frequency", 53, "int16", 0.01, "Hz", None),
+    ("Diesel Generator Output Frequency", 54, "int16", 0.01, "Hz", None),
+    ("Maximum Temperature", 56, "uint16", 0.1, "°C", None),
+    ("Inverter Working Stage", 57, "uint16", None, "", None),
+    ("External CT Power A", 58, "uint16", 0.01, "W", "measurement"),
+    ("External CT Power B", 59, "uint16", 0.01, "W", "measurement"),
+    ("External CT Power C", 60, "uint16", 0.01, "W", "measurement"),
+    ("External CT Current A", 61, "uint16", 0.01, "A", None),
+    ("External CT Current B", 62, "uint16", 0.01, "A", None),
+    ("Battery Voltage", 2026, "int16", 0.01, "V", None),
+    ("Battery Current", 2027, "int16", 0.1, "A", None),
+    ("Photovoltaic 1 Voltage", 2028, "int16", 0.1, "V", None),
+    ("Photovoltaic 1 Current", 2029, "int16", 0.01, "A", None),
+    ("Photovoltaic 2 Voltage", 2030, "int16", 0.1, "V", None),
+    ("Photovoltaic 2 Current", 2031, "int16", 0.01, "A", None),
+    ("DC Bus Voltage", 2032, "int16", 0.1, "V", None),
+    ("DC Positive Bus Voltage", 2033, "int16", 0.1, "V", None),
+    ("Buck Voltage", 2034, "int16", 0.1, "V", None),
+    ("Buck Current", 2035, "int16", 0.01, "A", None),
+    ("Battery Power", 2036, "int16", 1.0, "W", "measurement"),
+    ("Photovoltaic 1 Power", 2037, "int16", 1.0, "W", "measurement"),
+    ("Photovoltaic 2 Power", 2038, "int16", 1.0, "W", "measurement"),
+    ("Battery SOC", 2039, "uint16", 1.0, "%", "measurement"),
+)
 
 class ChisageInverter(ModbusDevice):
     def __init__(self, name: str, slave: int, host: str = "192.168.178.209", default_sensor_scan_interval: int = 20):
         inverter_sensors = [
-            ModbusRegister(name=f"{name} Inverter Voltage A", slave=slave, address=26, data_type="uint16", scale=0.1, unit_of_measurement="V"),
-            ModbusRegister(name=f"{name} Inverter Voltage B", slave=slave, address=27, data_type="uint16", scale=0.1, unit_of_measurement="V"),
-            ModbusRegister(name=f"{name} Inverter Voltage C", slave=slave, address=28, data_type="uint16", scale=0.1, unit_of_measurement="V"),
-            ModbusRegister(name=f"{name} Inverter Current A", slave=slave, address=29, data_type="uint16", scale=0.01, unit_of_measurement="A"),
-            ModbusRegister(name=f"{name} Inverter Current B", slave=slave, address=30, data_type="uint16", scale=0.01, unit_of_measurement="A"),
-            ModbusRegister(name=f"{name} Inverter Current C", slave=slave, address=31, data_type="uint16", scale=0.01, unit_of_measurement="A"),
-            ModbusRegister(name=f"{name} Grid Voltage A", slave=slave, address=32, data_type="uint16", scale=0.1, unit_of_measurement="V"),
-            ModbusRegister(name=f"{name} Grid Voltage B", slave=slave, address=33, data_type="uint16", scale=0.1, unit_of_measurement="V"),
-            ModbusRegister(name=f"{name} Grid Voltage C", slave=slave, address=34, data_type="uint16", scale=0.1, unit_of_measurement="V"),
-            ModbusRegister(name=f"{name} Grid Current A", slave=slave, address=35, data_type="uint16", scale=0.01, unit_of_measurement="A"),
-            ModbusRegister(name=f"{name} Grid Current B", slave=slave, address=36, data_type="uint16", scale=0.01, unit_of_measurement="A"),
-            ModbusRegister(name=f"{name} Grid Current C", slave=slave, address=37, data_type="uint16", scale=0.01, unit_of_measurement="A"),
-            ModbusRegister(name=f"{name} Load Voltage A", slave=slave, address=38, data_type="uint16", scale=0.1, unit_of_measurement="V"),
-            ModbusRegister(name=f"{name} Load Voltage B", slave=slave, address=39, data_type="uint16", scale=0.1, unit_of_measurement="V"),
-            ModbusRegister(name=f"{name} Load Voltage C", slave=slave, address=40, data_type="uint16", scale=0.1, unit_of_measurement="V"),
-            ModbusRegister(name=f"{name} Load Current A", slave=slave, address=41, data_type="uint16", scale=0.01, unit_of_measurement="A"),
-            ModbusRegister(name=f"{name} Load Current B", slave=slave, address=42, data_type="uint16", scale=0.01, unit_of_measurement="A"),
-            ModbusRegister(name=f"{name} Load Current C", slave=slave, address=43, data_type="uint16", scale=0.01, unit_of_measurement="A"),
-            ModbusRegister(name=f"{name} Diesel Generator Voltage A", slave=slave, address=44, data_type="uint16", scale=0.1, unit_of_measurement="V"),
-            ModbusRegister(name=f"{name} Diesel Generator Voltage B", slave=slave, address=45, data_type="uint16", scale=0.1, unit_of_measurement="V"),
-            ModbusRegister(name=f"{name} Diesel Generator Voltage C", slave=slave, address=46, data_type="uint16", scale=0.1, unit_of_measurement="V"),
-            ModbusRegister(name=f"{name} Diesel Generator Current A", slave=slave, address=47, data_type="uint16", scale=0.01, unit_of_measurement="A"),
-            ModbusRegister(name=f"{name} Diesel Generator Current B", slave=slave, address=48, data_type="uint16", scale=0.01, unit_of_measurement="A"),
-            ModbusRegister(name=f"{name} Diesel Generator Current C", slave=slave, address=49, data_type="uint16", scale=0.01, unit_of_measurement="A"),
-            ModbusRegister(name=f"{name} Inverter Positive Bus Voltage", slave=slave, address=50, data_type="uint16", scale=0.1, unit_of_measurement="V"),
-            ModbusRegister(name=f"{name} Negative Bus Voltage", slave=slave, address=51, data_type="uint16", scale=0.1, unit_of_measurement="V"),
-            ModbusRegister(name=f"{name} Inverter Frequency", slave=slave, address=52, data_type="int16", scale=0.01, unit_of_measurement="Hz"),
-            ModbusRegister(name=f"{name} Grid Frequency", slave=slave, address=53, data_type="int16", scale=0.01, unit_of_measurement="Hz"),
-            ModbusRegister(name=f"{name} Diesel Generator Output Frequency", slave=slave, address=54, data_type="int16", scale=0.01, unit_of_measurement="Hz"),
-            ModbusRegister(name=f"{name} Maximum Temperature", slave=slave, address=56, data_type="uint16", scale=0.1, unit_of_measurement="°C"),
-            ModbusRegister(name=f"{name} Inverter Working Stage", slave=slave, address=57, data_type="uint16", unit_of_measurement=""),
-            ModbusRegister(name=f"{name} External CT Power A", slave=slave, address=58, data_type="uint16", scale=0.01, unit_of_measurement="W", state_class="measurement"),
-            ModbusRegister(name=f"{name} External CT Power B", slave=slave, address=59, data_type="uint16", scale=0.01, unit_of_measurement="W", state_class="measurement"),
-            ModbusRegister(name=f"{name} External CT Power C", slave=slave, address=60, data_type="uint16", scale=0.01, unit_of_measurement="W", state_class="measurement"),
-            ModbusRegister(name=f"{name} External CT Current A", slave=slave, address=61, data_type="uint16", scale=0.01, unit_of_measurement="A"),
-            ModbusRegister(name=f"{name} External CT Current B", slave=slave, address=62, data_type="uint16", scale=0.01, unit_of_measurement="A"),
-            ModbusRegister(name=f"{name} Battery Voltage", slave=slave, address=2026, data_type="int16", scale=0.01, unit_of_measurement="V"),
-            ModbusRegister(name=f"{name} Battery Current", slave=slave, address=2027, data_type="int16", scale=0.1, unit_of_measurement="A"),
-            ModbusRegister(name=f"{name} Photovoltaic 1 Voltage", slave=slave, address=2028, data_type="int16", scale=0.1, unit_of_measurement="V"),
-            ModbusRegister(name=f"{name} Photovoltaic 1 Current", slave=slave, address=2029, data_type="int16", scale=0.01, unit_of_measurement="A"),
-            ModbusRegister(name=f"{name} Photovoltaic 2 Voltage", slave=slave, address=2030, data_type="int16", scale=0.1, unit_of_measurement="V"),
-            ModbusRegister(name=f"{name} Photovoltaic 2 Current", slave=slave, address=2031, data_type="int16", scale=0.01, unit_of_measurement="A"),
-            ModbusRegister(name=f"{name} DC Bus Voltage", slave=slave, address=2032, data_type="int16", scale=0.1, unit_of_measurement="V"),
-            ModbusRegister(name=f"{name} DC Positive Bus Voltage", slave=slave, address=2033, data_type="int16", scale=0.1, unit_of_measurement="V"),
-            ModbusRegister(name=f"{name} Buck Voltage", slave=slave, address=2034, data_type="int16", scale=0.1, unit_of_measurement="V"),
-            ModbusRegister(name=f"{name} Buck Current", slave=slave, address=2035, data_type="int16", scale=0.01, unit_of_measurement="A"),
-            ModbusRegister(name=f"{name} Battery Power", slave=slave, address=2036, data_type="int16", scale=1.0, unit_of_measurement="W", state_class="measurement"),
-            ModbusRegister(name=f"{name} Photovoltaic 1 Power", slave=slave, address=2037, data_type="int16", scale=1.0, unit_of_measurement="W", state_class="measurement"),
-            ModbusRegister(name=f"{name} Photovoltaic 2 Power", slave=slave, address=2038, data_type="int16", scale=1.0, unit_of_measurement="W", state_class="measurement"),
-            ModbusRegister(name=f"{name} Battery SOC", slave=slave, address=2039, data_type="uint16", scale=1.0, unit_of_measurement="%", state_class="measurement"),
+            ModbusRegister(name=f"{name} {suffix}", slave=slave, address=address, data_type=data_type,
+                           scale=scale, unit_of_measurement=unit, state_class=state_class, short_name=suffix)
+            for (suffix, address, data_type, scale, unit, state_class) in _INVERTER_SENSOR_SPECS
         ]
         super().__init__(name, slave, host, default_sensor_scan_interval, inverter_sensors)
 
+# Highest address reachable with --ip-start (255.255.255.255)
+_MAX_IPV4_INT = (1 << ipaddress.IPV4LENGTH) - 1
+_MAX_PORT = 65535
+
+def port_number(value: str) -> int:
+    # argparse type= hook: a TCP port in 1-65535
+    try:
+        port = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid port number: '{value}'")
+    if not 1 <= port <= _MAX_PORT:
+        raise argparse.ArgumentTypeError(f"port must be between 1 and {_MAX_PORT}, got {port}")
+    return port
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate Chisage Inverter Modbus configurations for Home Assistant.")
@@ -209,20 +503,22 @@ if __name__ == "__main__":
 
     # IP arguments - mutually exclusive group
     ip_group = parser.add_mutually_exclusive_group(required=True)
-    ip_group.add_argument("--ip-start", type=str, 
-                          help="Starting IP address for incremental assignment (e.g., 192.168.1.10). Last octet will be incremented.")
-    ip_group.add_argument("--ip-fixed", type=str, 
+    ip_group.add_argument("--ip-start", type=ipaddress.IPv4Address, 
+                          help="Starting IP address for incremental assignment (e.g., 192.168.1.10). Incremented by 1 per inverter, carrying into the next octet past .255.")
+    ip_group.add_argument("--ip-fixed", type=ipaddress.IPv4Address, 
                           help="Fixed IP address to use for ALL inverters (e.g., 192.168.1.100).")
 
     # Port arguments - mutually exclusive group
     port_group = parser.add_mutually_exclusive_group(required=True)
-    port_group.add_argument("--port-start", type=int, 
+    port_group.add_argument("--port-start", type=port_number, 
                             help="Starting port number for incremental assignment (e.g., 5001). Will be incremented.")
-    port_group.add_argument("--port-fixed", type=int, 
+    port_group.add_argument("--port-fixed", type=port_number, 
                             help="Fixed port number to use for ALL inverters (e.g., 5000).")
     
     parser.add_argument("--generate-cards", action="store_true", 
                         help="If set, generate Lovelace card YAML configuration files for each inverter.")
+    parser.add_argument("--safe-yaml", action="store_true", 
+                        help="Write sensor and card files with PyYAML instead of the built-in fixed-schema writer / JSON (slower, useful for validating output).")
     # Optional: could add --default-sensor-scan-interval if needed later
 
     args = parser.parse_args()
@@ -230,61 +526,57 @@ if __name__ == "__main__":
     inverter_count_num = args.count
     slave_id_val = args.slave_id
 
+    # Cross-argument checks argparse can't express, reported the same way as its own errors
+    if inverter_count_num <= 0:
+        parser.error("--count must be a positive integer.")
+
+    if args.ip_start is not None and int(args.ip_start) + inverter_count_num - 1 > _MAX_IPV4_INT:
+        parser.error(f"IP address range overflow for --ip-start. Incrementing {args.ip_start} by {inverter_count_num - 1} goes past 255.255.255.255. "
+                     "Please check --ip-start and --count to ensure the range is valid.")
+
+    if args.port_start is not None and args.port_start + inverter_count_num - 1 > _MAX_PORT:
+        parser.error(f"Port range overflow for --port-start. Incrementing {args.port_start} by {inverter_count_num - 1} goes past {_MAX_PORT}. "
+                     "Please check --port-start and --count to ensure the range is valid.")
+
     # --- IP Address Setup ---
+    # argparse already parsed and validated the addresses (type=ipaddress.IPv4Address)
     ip_mode_is_start = False
-    if args.ip_start:
+    if args.ip_start is not None:
         ip_mode_is_start = True
-        ip_to_process = args.ip_start
-        try:
-            ip_octets = ip_to_process.split('.')
-            if len(ip_octets) != 4 or not all(o.isdigit() and 0 <= int(o) <= 255 for o in ip_octets):
-                raise ValueError("Invalid IP address format for --ip-start. Must be A.B.C.D with octets 0-255.")
-            base_ip_prefix = ".".join(ip_octets[:3])
-            last_octet_start = int(ip_octets[3])
-            print(f"IP Mode: Incremental, starting from {args.ip_start}")
-        except ValueError as e:
-            print(f"Error: {e}")
-            exit(1)
-    elif args.ip_fixed:
-        ip_to_process = args.ip_fixed
-        try:
-            ip_octets = ip_to_process.split('.')
-            if len(ip_octets) != 4 or not all(o.isdigit() and 0 <= int(o) <= 255 for o in ip_octets):
-                raise ValueError("Invalid IP address format for --ip-fixed. Must be A.B.C.D with octets 0-255.")
-            fixed_ip_str = ip_to_process # Store validated fixed IP
-            print(f"IP Mode: Fixed, using {fixed_ip_str} for all inverters")
-        except ValueError as e:
-            print(f"Error: {e}")
-            exit(1)
+        # Integer form so incrementing carries across octet boundaries (x.x.x.255 + 1 -> x.x.(x+1).0)
+        base_ip_int = int(args.ip_start)
+        print(f"IP Mode: Incremental, starting from {args.ip_start}")
+    else:
+        fixed_ip_str = str(args.ip_fixed)
+        print(f"IP Mode: Fixed, using {fixed_ip_str} for all inverters")
     # Mutually exclusive group with required=True ensures one is present
 
     # --- Port Number Setup ---
     port_mode_is_start = False
-    if args.port_start:
+    if args.port_start is not None:
         port_mode_is_start = True
         port_to_process = args.port_start
         print(f"Port Mode: Incremental, starting from {port_to_process}")
-    elif args.port_fixed:
+    else:
         port_to_process = args.port_fixed
         print(f"Port Mode: Fixed, using {port_to_process} for all inverters")
     # Mutually exclusive group with required=True ensures one is present
-
-    if inverter_count_num <= 0:
-        print("Error: Count must be a positive integer.")
-        exit(1)
         
     print(f"\nGenerating {inverter_count_num} inverter configuration(s):")
     print(f"Slave ID for all: {slave_id_val}\n")
 
-    for i in range(inverter_count_num):
+    os.makedirs("chisage", exist_ok=True)
+
+    # Parse the existing hub list once up front and write it back once after the loop
+    hubs_by_name = load_modbus_hubs()
+
+    def generate_inverter(i: int) -> tuple[ChisageInverter, dict, Optional[str]]:
+        # Runs on a worker thread: builds one inverter and writes its own sensor (and card) file.
+        # Nothing shared is touched here; the hub list is merged and printed on the main thread.
+
         # Determine current_host_ip
         if ip_mode_is_start:
-            current_last_octet = last_octet_start + i
-            if current_last_octet > 255:
-                print(f"Error: IP address range overflow for --ip-start. Incrementing {args.ip_start} by {i} results in an invalid octet: {current_last_octet}.")
-                print("Please check --ip-start and --count to ensure the range is valid.")
-                exit(1)
-            current_host_ip = f"{base_ip_prefix}.{current_last_octet}"
+            current_host_ip = str(ipaddress.IPv4Address(base_ip_int + i))
         else: # ip_fixed mode
             current_host_ip = fixed_ip_str
 
@@ -294,64 +586,29 @@ if __name__ == "__main__":
         else: # port_fixed mode
             current_port_val = port_to_process
             
-        device_instance_name = f"Chisage {i + 1}"
-
-        print(f"  Creating Inverter {i+1}: Name='{device_instance_name}', Host={current_host_ip}, Port={current_port_val}, SlaveID={slave_id_val}")
-
         inverter_device = ChisageInverter(
-            name=device_instance_name,
+            name=f"Chisage {i + 1}",
             slave=slave_id_val,
             host=current_host_ip
         )
         
-        inverter_device.make_config(device_port_for_hub=current_port_val)
-        
-        if args.generate_cards:
-            device_identifier_for_file = device_instance_name.lower().replace(' ', '_')
-            card_entities = []
-            for reg in inverter_device.sensors:
-                # reg.name is already like "Chisage 1 Inverter Voltage A"
-                # Home Assistant's Modbus integration typically creates entity IDs like:
-                # sensor.hub_name_sensor_name (all lowercase, spaces to underscores)
-                # The hub name is inverter_device.name (e.g., "Chisage 1")
-                # The sensor name on the hub is reg.name itself.
-                
-                # Sanitize hub name for entity ID part
-                hub_name_sanitized = inverter_device.name.lower().replace(" ", "_")
-                # Sanitize sensor name for entity ID part
-                sensor_name_sanitized = reg.name.lower().replace(" ", "_")
-                
-                # If sensor name already contains hub name, avoid duplication for suffix
-                # This logic assumes sensor names like "Chisage 1 Power" and hub name "Chisage 1"
-                # We want entity id sensor.chisage_1_power
-                # The Modbus integration does this: sensor.[hub_name]_[sensor_name_from_config_on_hub]
-                # Our current reg.name is the full desired name, also used in sensor config
-
-                entity_id = f"sensor.{sensor_name_sanitized}" # reg.name already has device name
-
-                # For display name in card, try to make it cleaner by removing device prefix
-                display_name_in_card = reg.name
-                if display_name_in_card.startswith(inverter_device.name + " "):
-                    display_name_in_card = display_name_in_card[len(inverter_device.name) + 1:]
-                
-                card_entities.append({
-                    "entity": entity_id,
-                    "name": display_name_in_card
-                })
-
-            card_config = {
-                "type": "entities",
-                "title": inverter_device.name, # e.g., "Chisage 1"
-                "entities": card_entities
-            }
-
-            os.makedirs("chisage", exist_ok=True)
-            card_filename = f"chisage/{device_identifier_for_file}_card.yaml"
-            
-            with open(card_filename, "w") as f_card:
-                yaml.dump(card_config, f_card, sort_keys=False, indent=2)
-            print(f"    Generated card: {card_filename}")
+        hub_entry = inverter_device.make_config(device_port_for_hub=current_port_val, safe_yaml=args.safe_yaml)
+        card_filename = inverter_device.write_card_file(safe_yaml=args.safe_yaml) if args.generate_cards else None
+        return inverter_device, hub_entry, card_filename
+
+    # Each inverter writes only its own files, so the (I/O bound) writes can overlap;
+    # map() yields results in submission order, which keeps the output and hub order deterministic
+    with ThreadPoolExecutor(max_workers=min(32, inverter_count_num)) as executor:
+        for i, (inverter_device, hub_entry, card_filename) in enumerate(executor.map(generate_inverter, range(inverter_count_num))):
+            print(f"  Creating Inverter {i+1}: Name='{inverter_device.name}', Host={inverter_device.host}, Port={hub_entry['port']}, SlaveID={slave_id_val}")
+
+            hubs_by_name[hub_entry["name"]] = hub_entry
+
+            if card_filename is not None:
+                print(f"    Generated card: {card_filename}")
         
+    write_modbus_hubs(hubs_by_name)
+
     print(f"\nSuccessfully generated configurations.")
     print(f"Main Modbus hub configuration updated in: modbus_devices.yaml")
     print(f"Sensor-specific configurations are in the 'chisage' directory (e.g., chisage/chisage_1_sensors.yaml).")
\ No newline at end of file